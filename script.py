@@ -1,8 +1,18 @@
 import os
 import sys
+import json
+import time
+import shelve
+import threading
 import logging
 import requests
 import argparse
+from queue import Queue
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlencode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
 
@@ -14,13 +24,67 @@ logger = logging.getLogger(__name__)
 NEO4J_URI = "bolt://localhost:7687"
 NEO4J_USERNAME = os.getenv("NEO4J_USER")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
+# Пакетная запись идёт через HTTP API Neo4j, запросы на чтение — через bolt
+NEO4J_HTTP_URL = os.getenv("NEO4J_HTTP_URL", "http://localhost:7474")
+NEO4J_DATABASE = os.getenv("NEO4J_DATABASE", "neo4j")
 
 # Параметры VK API
 VK_API_BASE_URL = "https://api.vk.com/method/"
 VK_API_VERSION = "5.131"
 VK_ACCESS_TOKEN = os.getenv('VK_ACCESS_TOKEN')
+VK_COMMON_PARAMS = {
+    'access_token': VK_ACCESS_TOKEN,
+    'v': VK_API_VERSION,
+    'lang': 'ru'
+}
+# id, first_name и last_name VK возвращает всегда; city нужен как запасной вариант для home_town
+USER_FIELDS = "sex,home_town,city,screen_name"
+
+# execute выполняет до 25 вызовов API, на одного пользователя их приходится 2-3
+VK_EXECUTE_MAX_CALLS = 25
+
+# Размер пакета для записи в Neo4j через UNWIND
+BATCH_SIZE = 1000
+# Сколько пакетов может ждать записи, прежде чем обход VK приостановится
+WRITE_QUEUE_SIZE = 100
+
+# Количество параллельных запросов к VK API при обходе уровня BFS; частоту ограничивает vk_throttle,
+# потоков нужно лишь столько, чтобы execute-запросы длительностью в пару секунд не простаивали
+MAX_WORKERS = 8
+
+# VK допускает около 3 запросов в секунду на токен; при ошибке 6 запрос повторяется с задержкой
+VK_REQUESTS_PER_SECOND = 3
+VK_TOO_MANY_REQUESTS = 6
+VK_MAX_RETRIES = 5
+VK_RETRY_BACKOFF = 0.5
+
+# Кэш ответов VK API на диске, чтобы повторные запуски не ходили в сеть
+VK_CACHE_PATH = os.getenv('VK_CACHE_PATH', '.vk_cache')
+VK_CACHE_TTL = int(os.getenv('VK_CACHE_TTL', 24 * 60 * 60))
+
+# Кэш результатов запросов --query, сбрасывается после каждой загрузки данных
+QUERY_CACHE_PATH = os.getenv('QUERY_CACHE_PATH', '.query_cache')
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 5 * 60))
 
 neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USERNAME, NEO4J_PASSWORD))
+# Кэш VK открывается только при сборе данных, см. open_vk_cache
+vk_cache = None
+
+# Общая HTTP-сессия: соединения с VK (https) и HTTP API Neo4j (по умолчанию http) переиспользуются
+# между запросами и потоками. POST в Neo4j Retry повторяет только при ошибке соединения,
+# повтор по статусу ответа urllib3 делает лишь для идемпотентных методов. После исчерпания повторов
+# возвращается последний ответ, чтобы vk_api_call залогировал ошибку, а не прервал обход исключением
+http_adapter = HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+)
+http_session = requests.Session()
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+vk_cache_lock = threading.Lock()
+vk_rate_lock = threading.Lock()
+vk_next_call_at = 0.0
 
 
 def parse_arguments():
@@ -33,164 +97,389 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def vk_api_call(method, params):
-    params.update({
-        'access_token': VK_ACCESS_TOKEN,
-        'v': VK_API_VERSION,
-        'lang': 'ru'
-    })
-    response = requests.get(VK_API_BASE_URL + method, params=params)
-    if response.status_code == 200:
+def vk_throttle():
+    # Запросы из всех потоков выстраиваются с интервалом, допустимым для одного токена VK
+    global vk_next_call_at
+    with vk_rate_lock:
+        now = time.monotonic()
+        wait = vk_next_call_at - now
+        vk_next_call_at = max(now, vk_next_call_at) + 1 / VK_REQUESTS_PER_SECOND
+    if wait > 0:
+        time.sleep(wait)
+
+
+def open_vk_cache():
+    global vk_cache
+    vk_cache = shelve.open(VK_CACHE_PATH)
+
+
+def vk_cache_key(method, params):
+    return method + "?" + urlencode(sorted(params.items()))
+
+
+def vk_cache_get(cache_key):
+    with vk_cache_lock:
+        cached = vk_cache.get(cache_key)
+    if cached and time.time() - cached[0] < VK_CACHE_TTL:
+        return cached[1]
+    return None
+
+
+def vk_cache_put(cache_key, value):
+    with vk_cache_lock:
+        vk_cache[cache_key] = (time.time(), value)
+
+
+def vk_api_call(method, params, use_cache=True):
+    cache_key = vk_cache_key(method, params)
+    if use_cache:
+        cached = vk_cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+    for attempt in range(VK_MAX_RETRIES + 1):
+        vk_throttle()
+        try:
+            response = http_session.get(VK_API_BASE_URL + method, params={**VK_COMMON_PARAMS, **params})
+        except requests.RequestException as error:
+            logger.error(f"Ошибка соединения с VK API: {error}")
+            return None
+        if response.status_code != 200:
+            break
         result = response.json()
+        # VK сообщает о превышении частоты запросов не статусом 429, а ошибкой 6 в теле ответа
+        if result.get('error', {}).get('error_code') != VK_TOO_MANY_REQUESTS or attempt == VK_MAX_RETRIES:
+            break
+        time.sleep(VK_RETRY_BACKOFF * 2 ** attempt)
+
+    if response.status_code == 200:
         if 'error' in result:
             logger.error(f"Ошибка VK API: {result['error']['error_msg']}")
             return None
+        for error in result.get('execute_errors', []):
+            logger.warning(f"Ошибка VK API в execute ({error['method']}): {error['error_msg']}")
+        if use_cache:
+            vk_cache_put(cache_key, result.get('response'))
         return result.get('response')
     else:
         logger.error(f"HTTP ошибка: {response.status_code} - {response.text}")
         return None
 
 
+def vk_execute(calls):
+    # Каждый вложенный вызов кэшируется отдельно, в execute уходят только отсутствующие в кэше
+    keys = [vk_cache_key(method, params) for method, params in calls]
+    results = [vk_cache_get(key) for key in keys]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        code = build_execute_code([calls[i] for i in pending])
+        response = vk_api_call("execute", {"code": code}, use_cache=False)
+        for i, value in zip(pending, response or []):
+            # false — ошибка вложенного вызова (она есть в execute_errors), такой ответ не кэшируется
+            if value is not False and value is not None:
+                vk_cache_put(keys[i], value)
+                results[i] = value
+    return results
+
+
 def fetch_user_info(user_id):
     params = {
         "user_ids": user_id,
-        "fields": "first_name,last_name,sex,home_town,city,screen_name"
+        "fields": USER_FIELDS
     }
     return vk_api_call("users.get", params)
 
 
-def fetch_followers(user_id):
-    params = {
-        "user_id": user_id
-    }
-    return vk_api_call("users.getFollowers", params)
-
+# Обработка результата вызова на стороне VK до возврата из execute. Из подписок остаются только
+# публичные страницы: groups.get с filter=publics сделал бы это сам, но работает лишь с ключом
+# пользователя, а users.getSubscriptions доступен и по сервисному ключу. При ошибке вызова r{i}
+# остаётся false и не попадает в кэш
+VKSCRIPT_POSTPROCESS = {
+    'users.getSubscriptions': (
+        'if (r{i}) {{ var p{i} = []; var j{i} = 0; '
+        'while (j{i} < r{i}.items.length) {{ '
+        'if (r{i}.items[j{i}].type == "page") {{ p{i}.push(r{i}.items[j{i}]); }} j{i} = j{i} + 1; }} '
+        'r{i} = {{"count": p{i}.length, "items": p{i}}}; }}'
+    ),
+}
+
+
+def vkscript_call(method, params):
+    return f"API.{method}({json.dumps(params)})"
+
+
+def build_execute_code(calls):
+    lines = []
+    for i, (method, params) in enumerate(calls):
+        lines.append(f"var r{i} = {vkscript_call(method, params)};")
+        if method in VKSCRIPT_POSTPROCESS:
+            lines.append(VKSCRIPT_POSTPROCESS[method].format(i=i))
+    lines.append(f"return [{', '.join(f'r{i}' for i in range(len(calls)))}];")
+    return "\n".join(lines)
+
+
+def split_into_bundles(nodes):
+    chunks = []
+    chunk = []
+    calls = 0
+    for uid, user_details in nodes:
+        node_calls = 2 if user_details else 3
+        if calls + node_calls > VK_EXECUTE_MAX_CALLS:
+            chunks.append(chunk)
+            chunk = []
+            calls = 0
+        chunk.append((uid, user_details))
+        calls += node_calls
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def fetch_network_bundle(nodes):
+    # Для каждого пользователя: профиль (если ещё не известен), фолловеры и публичные страницы с данными
+    calls = []
+    for uid, user_details in nodes:
+        if not user_details:
+            calls.append(("users.get", {"user_ids": uid, "fields": USER_FIELDS}))
+        calls.append(("users.getFollowers", {"user_id": uid, "fields": USER_FIELDS}))
+        calls.append(("users.getSubscriptions", {"user_id": uid, "extended": 1}))
+    results = iter(vk_execute(calls))
+
+    bundle = []
+    for uid, user_details in nodes:
+        if not user_details:
+            user_info = next(results)
+            user_details = user_info[0] if user_info else None
+        followers = next(results)
+        groups = next(results)
+        followers_info = followers['items'] if followers else []
+        groups_info = groups['items'] if groups else []
+        bundle.append((user_details, followers_info, groups_info))
+    return bundle
+
+
+def user_row(user_data):
+    city = user_data.get('city', {}).get('title', '')
+    hometown = user_data.get('home_town', '') or city
 
-def fetch_followers_details(follower_ids):
-    params = {
-        "user_ids": ",".join(map(str, follower_ids)),
-        "fields": "first_name,last_name,sex,home_town,city,screen_name"
+    return {
+        'id': user_data['id'],
+        'screen_name': user_data.get('screen_name', ''),
+        'name': f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}",
+        'sex': user_data.get('sex', ''),
+        'home_town': hometown
     }
-    return vk_api_call("users.get", params)
 
 
-def fetch_subscriptions(user_id):
-    params = {
-        "user_id": user_id,
-        "extended": 1
+def group_row(group_data):
+    return {
+        'id': group_data['id'],
+        'name': group_data.get('name', ''),
+        'screen_name': group_data.get('screen_name', '')
     }
-    return vk_api_call("users.getSubscriptions", params)
 
 
-def fetch_group_details(group_ids):
-    params = {
-        "group_ids": ",".join(map(str, group_ids)),
-        "fields": "name,screen_name"
-    }
-    return vk_api_call("groups.getById", params)
+def new_batch():
+    return {'users': [], 'groups': [], 'follows': [], 'subscriptions': []}
 
 
-def store_user(tx, user_data):
-    city = user_data.get('city', {}).get('title', '')
-    hometown = user_data.get('home_town', '') or city
+def batch_size(batch):
+    return sum(len(rows) for rows in batch.values())
 
-    tx.run(
-        """
-        MERGE (u:User {id: $id})
-        SET u.screen_name = $screen_name,
-            u.name = $full_name,
-            u.sex = $sex,
-            u.home_town = $home_town
-        """,
-        id=user_data['id'],
-        screen_name=user_data.get('screen_name', ''),
-        full_name=f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}",
-        sex=user_data.get('sex', ''),
-        home_town=hometown
-    )
 
-
-def store_group(tx, group_data):
-    tx.run(
-        """
-        MERGE (g:Group {id: $id})
-        SET g.name = $name,
-            g.screen_name = $screen_name
-        """,
-        id=group_data['id'],
-        name=group_data.get('name', ''),
-        screen_name=group_data.get('screen_name', '')
-    )
+def create_constraints():
+    # Уникальные индексы по id нужны, чтобы MERGE и MATCH искали узлы по индексу, а не сканированием
+    with neo4j_driver.session() as session:
+        session.run("CREATE CONSTRAINT user_id IF NOT EXISTS FOR (u:User) REQUIRE u.id IS UNIQUE")
+        session.run("CREATE CONSTRAINT group_id IF NOT EXISTS FOR (g:Group) REQUIRE g.id IS UNIQUE")
 
 
-def create_relationship(tx, from_id, to_id, relationship_type):
-    tx.run(
-        f"""
-        MATCH (a {{id: $from_id}})
-        MATCH (b {{id: $to_id}})
-        MERGE (a)-[:{relationship_type}]->(b)
-        """,
-        from_id=from_id,
-        to_id=to_id
-    )
-    logger.info(f"Создана связь {relationship_type} между {from_id} и {to_id}")
+STORE_USERS_QUERY = """
+UNWIND $users AS u
+MERGE (x:User {id: u.id})
+SET x += u
+"""
 
+STORE_GROUPS_QUERY = """
+UNWIND $groups AS g
+MERGE (x:Group {id: g.id})
+SET x += g
+"""
 
-def process_network(user_id, current_level, max_depth, max_nodes=200):
-    queue = [(user_id, current_level)]
-    processed = set()
-    node_count = 0
+CREATE_FOLLOWS_QUERY = """
+UNWIND $pairs AS p
+MATCH (a:User {id: p.from_id})
+MATCH (b:User {id: p.to_id})
+MERGE (a)-[:FOLLOWS]->(b)
+"""
 
-    while queue:
-        uid, level = queue.pop(0)
+CREATE_SUBSCRIPTIONS_QUERY = """
+UNWIND $pairs AS p
+MATCH (a:User {id: p.from_id})
+MATCH (b:Group {id: p.to_id})
+MERGE (a)-[:SUBSCRIBED_TO]->(b)
+"""
 
-        if uid in processed or level > max_depth:
-            continue
-        processed.add(uid)
-        node_count += 1
 
-        if node_count > max_nodes:
-            logger.info("Достигнут максимальный лимит узлов.")
+def neo4j_http_commit(statements):
+    response = http_session.post(
+        f"{NEO4J_HTTP_URL}/db/{NEO4J_DATABASE}/tx/commit",
+        json={'statements': statements},
+        auth=(NEO4J_USERNAME, NEO4J_PASSWORD)
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP ошибка Neo4j: {response.status_code} - {response.text}")
+    errors = response.json().get('errors')
+    if errors:
+        # Транзакция откатана целиком, поэтому пакет не считается записанным
+        raise RuntimeError(f"Ошибка Neo4j: {'; '.join(error['message'] for error in errors)}")
+
+
+def write_batch(batch):
+    # Узлы пишутся раньше связей, чтобы MATCH в UNWIND нашёл оба конца; все запросы идут одной транзакцией
+    statements = []
+    if batch['users']:
+        statements.append({'statement': STORE_USERS_QUERY, 'parameters': {'users': batch['users']}})
+    if batch['groups']:
+        statements.append({'statement': STORE_GROUPS_QUERY, 'parameters': {'groups': batch['groups']}})
+    if batch['follows']:
+        statements.append({'statement': CREATE_FOLLOWS_QUERY, 'parameters': {'pairs': batch['follows']}})
+    if batch['subscriptions']:
+        statements.append({'statement': CREATE_SUBSCRIPTIONS_QUERY, 'parameters': {'pairs': batch['subscriptions']}})
+    neo4j_http_commit(statements)
+
+
+def flush_batch(batch):
+    if not batch_size(batch):
+        return
+    write_batch(batch)
+    logger.info(f"Записано в Neo4j: {len(batch['users'])} пользователей, {len(batch['groups'])} групп, "
+                f"{len(batch['follows']) + len(batch['subscriptions'])} связей")
+    for rows in batch.values():
+        rows.clear()
+
+
+def fetch_level(executor, level_nodes):
+    # Узлы уровня упаковываются в вызовы execute, которые выполняются параллельно;
+    # ответы отдаются по мере готовности, чтобы запись в Neo4j шла одновременно с запросами к VK
+    chunks = split_into_bundles(level_nodes)
+    futures = {executor.submit(fetch_network_bundle, chunk): index for index, chunk in enumerate(chunks)}
+    for future in as_completed(futures):
+        index = futures[future]
+        for (uid, _), node in zip(chunks[index], future.result()):
+            yield index, uid, node
+
+
+def batch_writer(write_queue, writer_errors):
+    # Единственный поток записи: параллельная запись связей в Neo4j конфликтует из-за блокировок узлов
+    batch = new_batch()
+    while True:
+        payload = write_queue.get()
+        if payload is None:
             break
-
-        user_info = fetch_user_info(uid)
-        if not user_info:
-            logger.warning(f"Не удалось получить информацию о пользователе {uid}")
+        # После ошибки очередь только вычитывается, чтобы обход не завис на заполненной очереди
+        if writer_errors:
             continue
-        user_details = user_info[0]
-
-        with neo4j_driver.session() as session:
-            session.write_transaction(store_user, user_details)
-            logger.info(f"Добавлен пользователь {user_details['id']} на уровне {level}")
+        for key, rows in payload.items():
+            batch[key].extend(rows)
+        try:
+            if batch_size(batch) >= BATCH_SIZE:
+                flush_batch(batch)
+        except Exception as error:
+            writer_errors.append(error)
+    if not writer_errors:
+        try:
+            flush_batch(batch)
+        except Exception as error:
+            writer_errors.append(error)
+
+
+def process_network(user_id, current_level, max_depth, max_nodes=200, user_info=None):
+    processed = set()
+    # Профили, уже полученные вместе со списком фолловеров, повторно у VK не запрашиваются
+    user_info_cache = {user_id: user_info} if user_info else {}
+    frontier = deque([user_id])
+    # Пользователь попадает в очередь не больше одного раза, даже если он фолловер нескольких узлов;
+    # связь FOLLOWS при этом записывается для каждого из них
+    enqueued = {user_id}
+    level = current_level
+    write_queue = Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer_errors = []
+    writer = threading.Thread(target=batch_writer, args=(write_queue, writer_errors))
+    writer.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            while frontier and level <= max_depth:
+                level_nodes = []
+                while frontier and len(processed) < max_nodes:
+                    uid = frontier.popleft()
+                    if uid in processed:
+                        continue
+                    processed.add(uid)
+                    level_nodes.append((uid, user_info_cache.pop(uid, None)))
+
+                # Фолловеры собираются по номеру чанка, чтобы порядок следующего уровня не зависел от того,
+                # какой execute-запрос ответил раньше
+                chunk_followers = {}
+                groups_added = 0
+                for index, uid, (user_details, followers_info, groups_info) in fetch_level(executor, level_nodes):
+                    if not user_details:
+                        logger.warning(f"Не удалось получить информацию о пользователе {uid}")
+                        continue
+
+                    payload = new_batch()
+                    payload['users'].append(user_row(user_details))
+                    logger.debug("Добавлен пользователь %s на уровне %d", user_details['id'], level)
 
-            followers = fetch_followers(uid)
-            if followers:
-                follower_ids = followers['items']
-                followers_info = fetch_followers_details(follower_ids)
-                if followers_info:
                     for follower in followers_info:
                         fid = follower['id']
+                        # Профиль фолловера пишется в том же пакете, что и связь: узел того же уровня
+                        # может быть ещё не записан, а MATCH в UNWIND не создаёт недостающих концов
+                        payload['users'].append(user_row(follower))
+                        payload['follows'].append({'from_id': fid, 'to_id': uid})
                         if fid not in processed:
-                            session.write_transaction(store_user, follower)
-                            session.write_transaction(create_relationship, fid, uid, "FOLLOWS")
-                            queue.append((fid, level + 1))
-                            logger.info(f"Добавлен фолловер {fid} для пользователя {uid} на уровне {level + 1}")
-
-            subscriptions = fetch_subscriptions(uid)
-            if subscriptions and 'items' in subscriptions:
-                group_ids = [item['id'] for item in subscriptions['items'] if item.get('type') == 'page']
-                if group_ids:
-                    groups_info = fetch_group_details(group_ids)
-                    if groups_info:
-                        for group in groups_info:
-                            gid = group['id']
-                            if gid not in processed:
-                                session.write_transaction(store_group, group)
-                                session.write_transaction(create_relationship, uid, gid, "SUBSCRIBED_TO")
-                                logger.info(f"Добавлена подписка на группу {gid} для пользователя {uid}")
-
-        logger.info(f"Завершена обработка уровня {level} для пользователя {uid}. Переход к уровню {level + 1}.\n")
-
+                            user_info_cache[fid] = follower
+                            chunk_followers.setdefault(index, []).append(fid)
+                            logger.debug("Добавлен фолловер %s для пользователя %s на уровне %d", fid, uid, level + 1)
+
+                    for group in groups_info:
+                        gid = group['id']
+                        if gid not in processed:
+                            payload['groups'].append(group_row(group))
+                            payload['subscriptions'].append({'from_id': uid, 'to_id': gid})
+                            groups_added += 1
+                            logger.debug("Добавлена подписка на группу %s для пользователя %s", gid, uid)
+
+                    write_queue.put(payload)
+                    if writer_errors:
+                        raise writer_errors[0]
+
+                next_frontier = deque()
+                for index in sorted(chunk_followers):
+                    for fid in chunk_followers[index]:
+                        if fid not in enqueued:
+                            enqueued.add(fid)
+                            next_frontier.append(fid)
+
+                # Новые пользователи уровня — это попавшие в очередь фолловеры, а на первом уровне ещё и сам корень
+                users_added = len(next_frontier) + (1 if level == current_level else 0)
+                logger.info("Завершена обработка уровня %d: +%d пользователей, +%d подписок на группы. Переход к уровню %d.",
+                            level, users_added, groups_added, level + 1)
+
+                if len(processed) >= max_nodes:
+                    logger.info("Достигнут максимальный лимит узлов.")
+                    break
+
+                frontier = next_frontier
+                level += 1
+
+    finally:
+        # Запись идёт в отдельном потоке; дожидаемся, пока он сбросит остаток буфера
+        write_queue.put(None)
+        writer.join()
+    if writer_errors:
+        raise writer_errors[0]
     logger.info("Обработка завершена.")
 
 def get_total_users(tx):
@@ -228,13 +517,60 @@ def get_top_groups(tx, limit):
 def get_mutual_followers(tx):
     query = """
     MATCH (u:User)-[:FOLLOWS]->(v:User)
-    WHERE (v)-[:FOLLOWS]->(u)
+    WHERE u.id < v.id AND (v)-[:FOLLOWS]->(u)
     RETURN u.name AS user1, v.name AS user2
     """
     result = tx.run(query)
     return result.data()
 
 
+def format_top_users(top_users):
+    lines = ["Топ пользователей по количеству фолловеров:"]
+    lines += [f"{user['user_name']}: {user['followers_count']} фолловеров" for user in top_users]
+    return "\n".join(lines)
+
+
+def format_top_groups(top_groups):
+    lines = ["Топ групп по количеству подписчиков:"]
+    lines += [f"{group['group_name']}: {group['subscribers_count']} подписчиков" for group in top_groups]
+    return "\n".join(lines)
+
+
+def format_mutual_followers(mutuals):
+    lines = ["Пары пользователей, которые являются фолловерами друг друга:"]
+    lines += [f"{pair['user1']} и {pair['user2']}" for pair in mutuals]
+    return "\n".join(lines)
+
+
+# Запрос --query -> (функция чтения, нужен ли ей --limit, форматирование результата)
+QUERY_HANDLERS = {
+    'total_users': (get_total_users, False, lambda total: f"Общее количество пользователей: {total}"),
+    'total_groups': (get_total_groups, False, lambda total: f"Общее количество групп: {total}"),
+    'top_users': (get_top_users_by_followers, True, format_top_users),
+    'top_groups': (get_top_groups, True, format_top_groups),
+    'mutual_followers': (get_mutual_followers, False, format_mutual_followers),
+}
+
+
+def cached_read(session, query_fn, *args):
+    # Файл кэша открывается только на время чтения и записи, чтобы не держать его во время запроса к Neo4j
+    cache_key = query_fn.__name__ + repr(args)
+    with shelve.open(QUERY_CACHE_PATH) as query_cache:
+        cached = query_cache.get(cache_key)
+    if cached and time.time() - cached[0] < QUERY_CACHE_TTL:
+        return cached[1]
+
+    result = session.read_transaction(query_fn, *args)
+    with shelve.open(QUERY_CACHE_PATH) as query_cache:
+        query_cache[cache_key] = (time.time(), result)
+    return result
+
+
+def clear_query_cache():
+    with shelve.open(QUERY_CACHE_PATH) as query_cache:
+        query_cache.clear()
+
+
 def main():
     if not VK_ACCESS_TOKEN:
         logger.error("Токен доступа VK API не найден.")
@@ -243,33 +579,19 @@ def main():
     args = parse_arguments()
 
     if args.query:
-        with neo4j_driver.session() as session:
-            if args.query == 'total_users':
-                total_users = session.read_transaction(get_total_users)
-                print(f"Общее количество пользователей: {total_users}")
-            elif args.query == 'total_groups':
-                total_groups = session.read_transaction(get_total_groups)
-                print(f"Общее количество групп: {total_groups}")
-            elif args.query == 'top_users':
-                top_users = session.read_transaction(get_top_users_by_followers, args.limit)
-                print("Топ пользователей по количеству фолловеров:")
-                for user in top_users:
-                    print(f"{user['user_name']}: {user['followers_count']} фолловеров")
-            elif args.query == 'top_groups':
-                top_groups = session.read_transaction(get_top_groups, args.limit)
-                print("Топ групп по количеству подписчиков:")
-                for group in top_groups:
-                    print(f"{group['group_name']}: {group['subscribers_count']} подписчиков")
-            elif args.query == 'mutual_followers':
-                mutuals = session.read_transaction(get_mutual_followers)
-                print("Пары пользователей, которые являются фолловерами друг друга:")
-                for pair in mutuals:
-                    print(f"{pair['user1']} и {pair['user2']}")
-            else:
-                print("Используйте один из следующих запросов: total_users, total_groups, top_users, top_groups, mutual_followers")
+        handler = QUERY_HANDLERS.get(args.query)
+        if handler:
+            query_fn, uses_limit, format_result = handler
+            query_args = (args.limit,) if uses_limit else ()
+            with neo4j_driver.session() as session:
+                print(format_result(cached_read(session, query_fn, *query_args)))
+        else:
+            print(f"Используйте один из следующих запросов: {', '.join(QUERY_HANDLERS)}")
         neo4j_driver.close()
+        http_session.close()
         sys.exit(0)
 
+    open_vk_cache()
     user_id = args.user_id or '185283514'
 
     user_info = fetch_user_info(user_id)
@@ -280,11 +602,24 @@ def main():
         user_id = user_data['id']
         max_depth = args.max_depth
         max_nodes = args.max_nodes
-        process_network(user_id, 0, max_depth, max_nodes)
+        create_constraints()
+        try:
+            process_network(user_id, 0, max_depth, max_nodes, user_data)
+            exit_code = 0
+        except (RuntimeError, requests.RequestException) as error:
+            logger.error(f"Загрузка данных в Neo4j прервана: {error}")
+            exit_code = 1
+        finally:
+            # Пакеты, записанные до ошибки, остаются в Neo4j, поэтому кэш устаревает и при неудачной загрузке
+            clear_query_cache()
     else:
         logger.error("Не удалось получить данные о первом пользователе.")
+        exit_code = 1
 
     neo4j_driver.close()
+    http_session.close()
+    vk_cache.close()
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":